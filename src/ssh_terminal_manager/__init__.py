@@ -4,7 +4,12 @@ from __future__ import annotations
 
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from functools import lru_cache
 import logging
+import socket
+import time
+from typing import Any
 
 from terminal_manager import (
     DEFAULT_ALLOW_TURN_OFF,
@@ -45,21 +50,51 @@ from .ssh import SSH
 from .state import ONLINE, State
 
 _LOGGER = logging.getLogger(__name__)
-_TEST_COMMAND = Command("echo ''")
 
 DEFAULT_PORT = 22
 DEFAULT_PING_TIMEOUT = 4
 DEFAULT_SSH_TIMEOUT = 4
+DEFAULT_KEEPALIVE_INTERVAL = 30
+DEFAULT_ALLOW_AGENT = False
+DEFAULT_COMPRESS = False
 DEFAULT_ADD_HOST_KEYS = False
+DEFAULT_VERIFY_HOST_KEY_DNS = False
 DEFAULT_LOAD_SYSTEM_HOST_KEYS = False
 DEFAULT_DISCONNECT_MODE = False
+DEFAULT_DISCONNECT_DELAY = 0
 DEFAULT_INVOKE_SHELL = False
+DEFAULT_BATCH_SENSOR_COMMANDS = False
+DEFAULT_MAX_CHANNELS = 4
+
+# Seconds a successful ping is trusted before pinging again
+_ONLINE_TTL = 1
+
+# Workers mostly wait for remote commands, threads are only started on demand
+_EXECUTOR = ThreadPoolExecutor(max_workers=64, thread_name_prefix="SSH")
 
 
 async def _run_in_executor(func, *args):
     loop = asyncio.get_running_loop()
-    with ThreadPoolExecutor(thread_name_prefix="SSH") as executor:
-        return await loop.run_in_executor(executor, func, *args)
+    return await loop.run_in_executor(_EXECUTOR, func, *args)
+
+
+_wol_socket: socket.socket | None = None
+
+
+def _get_wol_socket() -> socket.socket:
+    global _wol_socket
+
+    if _wol_socket is None:
+        _wol_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        _wol_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        _wol_socket.setblocking(False)
+
+    return _wol_socket
+
+
+@lru_cache(maxsize=16)
+def _get_magic_packet(mac_address: str) -> bytes:
+    return wakeonlan.create_magic_packet(mac_address)
 
 
 class SSHManager(Manager):
@@ -74,11 +109,18 @@ class SSHManager(Manager):
         key_filename: str | None = None,
         host_keys_filename: str | None = None,
         add_host_keys: bool = DEFAULT_ADD_HOST_KEYS,
+        verify_host_key_dns: bool = DEFAULT_VERIFY_HOST_KEY_DNS,
         load_system_host_keys: bool = DEFAULT_LOAD_SYSTEM_HOST_KEYS,
+        allow_agent: bool = DEFAULT_ALLOW_AGENT,
+        compress: bool = DEFAULT_COMPRESS,
         invoke_shell: bool = DEFAULT_INVOKE_SHELL,
+        batch_sensor_commands: bool = DEFAULT_BATCH_SENSOR_COMMANDS,
+        max_channels: int = DEFAULT_MAX_CHANNELS,
         allow_turn_off: bool = DEFAULT_ALLOW_TURN_OFF,
         disconnect_mode: bool = DEFAULT_DISCONNECT_MODE,
+        disconnect_delay: int = DEFAULT_DISCONNECT_DELAY,
         ssh_timeout: int = DEFAULT_SSH_TIMEOUT,
+        keepalive_interval: int = DEFAULT_KEEPALIVE_INTERVAL,
         ping_timeout: int = DEFAULT_PING_TIMEOUT,
         command_timeout: int = DEFAULT_COMMAND_TIMEOUT,
         collection: Collection | None = None,
@@ -107,13 +149,22 @@ class SSHManager(Manager):
             key_filename,
             host_keys_filename,
             add_host_keys,
+            verify_host_key_dns,
             load_system_host_keys,
+            allow_agent,
+            compress,
             invoke_shell,
             disconnect_mode,
+            disconnect_delay,
             ssh_timeout,
+            keepalive_interval,
         )
         self._ssh.on_disconnect.subscribe(self._clear_sensors)
+        self._batch_sensor_commands = batch_sensor_commands
+        self._max_channels = max_channels
         self._mac_address = None
+        self._sensors: dict[str, Sensor] | None = None
+        self._online_until = 0.0
 
     @property
     def is_up(self) -> bool:
@@ -141,6 +192,40 @@ class SSHManager(Manager):
         """Set the MAC address."""
         self._mac_address = mac_address
 
+    def set_sensor_commands(self, sensor_commands: list[SensorCommand]) -> None:
+        super().set_sensor_commands(sensor_commands)
+        self._sensors = None
+
+    def add_sensor_command(self, command: SensorCommand) -> None:
+        super().add_sensor_command(command)
+        self._sensors = None
+
+    def remove_sensor(self, key: str) -> None:
+        super().remove_sensor(key)
+        self._sensors = None
+
+    def _last_known_value_or_none(self, sensor_key: str) -> Any | None:
+        if self._sensors is None:
+            self._sensors = {
+                sensor.key: sensor
+                for command in self.sensor_commands
+                for sensor in command.sensors
+                if sensor.key != PLACEHOLDER_KEY
+            }
+
+        if sensor := self._sensors.get(sensor_key):
+            return sensor.last_known_value
+
+        return super()._last_known_value_or_none(sensor_key)
+
+    def _clear_sensors(self) -> None:
+        for command in self.sensor_commands:
+            if any(
+                sensor.value is not None or sensor.child_sensors
+                for sensor in command.sensors
+            ):
+                command.update_sensors(self, None)
+
     async def async_connect(self) -> None:
         """Connect the SSH client.
 
@@ -186,6 +271,121 @@ class SSHManager(Manager):
         timeout = command_timeout or self.command_timeout
         return await _run_in_executor(self._ssh.execute_command_string, string, timeout)
 
+    async def async_update_sensor_commands(self, force: bool = False) -> None:
+        """Update the sensor commands.
+
+        Execute sensor commands that passed their `interval` or
+        all sensor commands with `force=True`.
+        Sensor commands that don't require other sensors are executed
+        concurrently on up to `max_channels` channels, or over a single
+        channel with `batch_sensor_commands`.
+        """
+        independent_commands = []
+        dependent_commands = []
+
+        for command in self.sensor_commands:
+            if not (force or command.should_update):
+                break
+            if command.required_sensors or command.required_variables:
+                dependent_commands.append(command)
+            else:
+                independent_commands.append(command)
+
+        if len(independent_commands) > 1:
+            await self._async_execute_sensor_commands(independent_commands)
+        else:
+            dependent_commands = independent_commands + dependent_commands
+
+        for command in dependent_commands:
+            with suppress(CommandError):
+                await self.async_execute_command(command)
+
+    async def _async_execute_strings(
+        self,
+        strings: list[str],
+        timeouts: list[int],
+    ) -> list[CommandOutput | CommandError]:
+        if self._batch_sensor_commands and not self._ssh.invoke_shell:
+            try:
+                return await _run_in_executor(
+                    self._ssh.execute_command_strings, strings, max(timeouts)
+                )
+            except CommandError as exc:
+                return [exc] * len(strings)
+
+        semaphore = asyncio.Semaphore(self._max_channels)
+
+        async def async_execute(string: str, timeout: int) -> CommandOutput:
+            async with semaphore:
+                return await _run_in_executor(
+                    self._ssh.execute_command_string, string, timeout
+                )
+
+        results = await asyncio.gather(
+            *(
+                async_execute(string, timeout)
+                for string, timeout in zip(strings, timeouts, strict=True)
+            ),
+            return_exceptions=True,
+        )
+
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(
+                result, CommandError
+            ):
+                raise result
+
+        return results
+
+    async def _async_execute_sensor_commands(
+        self,
+        commands: list[SensorCommand],
+    ) -> None:
+        outputs: list[CommandOutput | CommandError | None] = [None] * len(commands)
+        strings: dict[int, str] = {}
+
+        for i, command in enumerate(commands):
+            try:
+                strings[i] = (
+                    command.renderer(command.string)
+                    if command.renderer
+                    else command.string
+                )
+            except Exception as exc:  # noqa: BLE001
+                outputs[i] = CommandError("Failed to render string", exc)
+
+        if strings:
+            results = await self._async_execute_strings(
+                list(strings.values()),
+                [commands[i].timeout or self.command_timeout for i in strings],
+            )
+            for i, result in zip(strings, results, strict=True):
+                outputs[i] = result
+
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+
+        for command, output in zip(commands, outputs, strict=True):
+            if isinstance(output, CommandError):
+                if debug:
+                    self.logger.debug("%s: %s => %s", self.name, command.string, output)
+                command.update_sensors(self, None)
+                continue
+            if debug:
+                self.logger.debug(
+                    "%s: %s => %s, %s, %s",
+                    self.name,
+                    output.command_string,
+                    output.stdout,
+                    output.stderr,
+                    output.code,
+                )
+            try:
+                await self.async_poll_sensors(command.linked_sensors, raise_errors=True)
+            except CommandError:
+                command.update_sensors(self, None)
+            else:
+                command.update_sensors(self, output)
+
     async def async_update_state(
         self,
         *,
@@ -201,22 +401,19 @@ class SSHManager(Manager):
 
         """
         if self.state.connected:
-            try:
-                await self.async_execute_command(_TEST_COMMAND)
-            except CommandError:
-                pass
-            else:
+            if self._ssh.recently_active or await _run_in_executor(
+                self._ssh.check_alive
+            ):
+                self.state.update(ONLINE, True)
                 return
+            self._online_until = 0.0
+            await self.async_disconnect()
 
-        try:
-            online = await self._ping.async_ping(self.host)
-        except Exception as exc:  # noqa: BLE001
-            self.logger.warning("%s: Ping request failed (%s)", self.name, exc)
-            self.state.update(ONLINE, False)
-        else:
-            self.state.update(ONLINE, online)
+        if not self.state.online or time.monotonic() >= self._online_until:
+            await self._async_ping()
 
         if not self.state.online:
+            self._ssh.resolver.invalidate()
             if raise_errors:
                 raise OfflineError(self.host)
             return
@@ -227,6 +424,26 @@ class SSHManager(Manager):
             if raise_errors:
                 raise
 
+    async def _async_ping(self) -> None:
+        try:
+            addresses = await self._ssh.resolver.async_resolve()
+            results = await asyncio.gather(
+                *(self._ping.async_ping(address[0]) for _, address in addresses),
+                return_exceptions=True,
+            )
+            if results and all(isinstance(result, Exception) for result in results):
+                raise results[0]
+        except Exception as exc:  # noqa: BLE001
+            self.logger.warning("%s: Ping request failed (%s)", self.name, exc)
+            self.state.update(ONLINE, False)
+            return
+
+        online = any(result is True for result in results)
+        self.state.update(ONLINE, online)
+
+        if online:
+            self._online_until = time.monotonic() + _ONLINE_TTL
+
     async def async_turn_on(self) -> None:
         """Turn on by Wake on LAN.
 
@@ -237,8 +454,15 @@ class SSHManager(Manager):
         if self.mac_address is None:
             raise ValueError("No MAC Address set")
 
-        wakeonlan.send_magic_packet(self.mac_address)
-        self.logger.debug("%s: Magic packet sent to %s", self.name, self.mac_address)
+        _get_wol_socket().sendto(
+            _get_magic_packet(self.mac_address),
+            (wakeonlan.BROADCAST_IP, wakeonlan.DEFAULT_PORT),
+        )
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                "%s: Magic packet sent to %s", self.name, self.mac_address
+            )
 
     async def async_load_host_keys(self) -> None:
         """Load host keys."""
@@ -3,58 +3,172 @@ from contextlib import suppress
 
 import icmplib
 
+SEND_INTERVAL = 0.002
+MAX_PING_PROCESSES = 8
+
+
+class BatchPinger:
+    """Send echo requests to many hosts over one shared ICMP socket.
+
+    Replies are read by a single task per address family and routed to
+    the waiting requests by their identifier and sequence number.
+    Requests are spaced out by `SEND_INTERVAL` to avoid bursts.
+    """
+
+    def __init__(self) -> None:
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._sockets: dict[int, icmplib.AsyncSocket] = {}
+        self._readers: dict[int, asyncio.Task] = {}
+        self._pending: dict[tuple[int, int, int], asyncio.Future] = {}
+        self._sequence = 0
+        self._next_send = 0.0
+
+    def _get_socket(self, family: int) -> icmplib.AsyncSocket:
+        loop = asyncio.get_running_loop()
+
+        if loop is not self._loop:
+            self.close()
+            self._loop = loop
+
+        if not (sock := self._sockets.get(family)):
+            socket_class = icmplib.ICMPv6Socket if family == 6 else icmplib.ICMPv4Socket
+            sock = self._sockets[family] = icmplib.AsyncSocket(
+                socket_class(privileged=False)
+            )
+
+        return sock
+
+    async def _async_read(self, family: int, sock: icmplib.AsyncSocket) -> None:
+        while any(key[0] == family for key in self._pending):
+            try:
+                reply = await sock.receive(None, 1)
+            except icmplib.TimeoutExceeded:
+                continue
+            except icmplib.ICMPLibError as exc:
+                self._sockets.pop(family, None)
+                sock.close()
+                for key in [key for key in self._pending if key[0] == family]:
+                    self._pending.pop(key).set_exception(exc)
+                return
+            key = (family, reply.id, reply.sequence)
+            if (future := self._pending.pop(key, None)) and not future.done():
+                future.set_result(reply)
+
+    async def async_ping(self, address: str, timeout: float) -> bool:
+        """Ping an address and return `True` if it replied in time."""
+        now = asyncio.get_running_loop().time()
+        delay = max(self._next_send - now, 0)
+        self._next_send = now + delay + SEND_INTERVAL
+
+        if delay:
+            await asyncio.sleep(delay)
+
+        family = 6 if icmplib.is_ipv6_address(address) else 4
+        sock = self._get_socket(family)
+        self._sequence = (self._sequence + 1) & 0xFFFF
+        request = icmplib.ICMPRequest(address, icmplib.PID, self._sequence)
+        sock.send(request)
+
+        key = (family, request.id, request.sequence)
+        future = self._pending[key] = self._loop.create_future()
+
+        if (reader := self._readers.get(family)) is None or reader.done():
+            self._readers[family] = self._loop.create_task(
+                self._async_read(family, sock)
+            )
+
+        try:
+            reply = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._pending.pop(key, None)
+
+        try:
+            reply.raise_for_status()
+        except icmplib.ICMPError:
+            return False
+
+        return True
+
+    def close(self) -> None:
+        """Close the sockets and cancel pending requests."""
+        for reader in self._readers.values():
+            reader.cancel()
+        for future in self._pending.values():
+            future.cancel()
+        for sock in self._sockets.values():
+            sock.close()
+
+        self._readers.clear()
+        self._pending.clear()
+        self._sockets.clear()
+        self._next_send = 0.0
+
+
+_BATCH_PINGER = BatchPinger()
+
 
 class Ping:
     use_icmplib: bool | None = None
+    _process_loop: asyncio.AbstractEventLoop | None = None
+    _process_semaphore: asyncio.Semaphore | None = None
 
     def __init__(self, timeout: int) -> None:
         self._timeout = timeout
 
-    async def _async_test_icmplib(self) -> bool:
+    @staticmethod
+    def _test_icmplib() -> bool:
         try:
-            await icmplib.async_ping("127.0.0.1", count=0, timeout=0, privileged=False)
+            icmplib.ICMPv4Socket(privileged=False).close()
         except icmplib.SocketPermissionError:
             return False
         return True
 
     async def _async_ping_icmplib(self, host: str) -> bool:
-        result = await icmplib.async_ping(
-            host,
-            count=1,
-            timeout=self._timeout,
-            privileged=False,
-        )
-        return result.is_alive
+        return await _BATCH_PINGER.async_ping(host, self._timeout)
+
+    @staticmethod
+    def _get_process_semaphore() -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+
+        if loop is not Ping._process_loop:
+            Ping._process_loop = loop
+            Ping._process_semaphore = asyncio.Semaphore(MAX_PING_PROCESSES)
+
+        return Ping._process_semaphore
 
     async def _async_ping_process(self, host: str) -> bool:
+        async with self._get_process_semaphore():
+            return await self._async_run_ping_process(host)
+
+    async def _async_run_ping_process(self, host: str) -> bool:
         process = await asyncio.create_subprocess_exec(
             "ping",
             "-q",
             "-c1",
             f"-W{self._timeout}",
             host,
-            stdin=None,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            close_fds=False,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
         )
         try:
-            async with asyncio.timeout(self._timeout + 1):
-                await process.communicate()
-        except TimeoutError:
-            if process:
-                with suppress(TypeError):
-                    await process.kill()
+            returncode = await asyncio.wait_for(process.wait(), self._timeout + 1)
+        except asyncio.TimeoutError:
+            with suppress(ProcessLookupError):
+                process.kill()
+            await process.wait()
             return False
 
-        if process.returncode and process.returncode > 1:
-            raise RuntimeError(f"Exit code: {process.returncode}")
+        if returncode > 1:
+            raise RuntimeError(f"Exit code: {returncode}")
 
-        return process.returncode == 0
+        return returncode == 0
 
     async def async_ping(self, host: str):
-        if self.use_icmplib is None:
-            self.use_icmplib = await self._async_test_icmplib()
+        if Ping.use_icmplib is None:
+            Ping.use_icmplib = self._test_icmplib()
 
         if self.use_icmplib:
             return await self._async_ping_icmplib(host)
@@ -0,0 +1,67 @@
+from collections.abc import Hashable
+import threading
+
+import paramiko
+
+# Default of the OpenSSH MaxSessions option
+MAX_CHANNELS = 10
+
+
+class ClientPool:
+    """Share connected clients between users with the same settings."""
+
+    def __init__(self) -> None:
+        self._clients: dict[Hashable, tuple[paramiko.SSHClient, int]] = {}
+        self._channels: dict[Hashable, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _is_active(client: paramiko.SSHClient) -> bool:
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def acquire(self, key: Hashable) -> paramiko.SSHClient | None:
+        """Get a connected client for `key` if there is one."""
+        with self._lock:
+            if not (entry := self._clients.get(key)):
+                return None
+
+            client, users = entry
+
+            if not self._is_active(client):
+                del self._clients[key]
+                return None
+
+            self._clients[key] = (client, users + 1)
+            return client
+
+    def add(self, key: Hashable, client: paramiko.SSHClient) -> bool:
+        """Add a connected client, return `False` if `key` is taken."""
+        with self._lock:
+            if (entry := self._clients.get(key)) and self._is_active(entry[0]):
+                return False
+
+            self._clients[key] = (client, 1)
+            return True
+
+    def channels(self, key: Hashable) -> threading.BoundedSemaphore:
+        """Get the semaphore limiting open channels for `key`."""
+        with self._lock:
+            if not (channels := self._channels.get(key)):
+                channels = self._channels[key] = threading.BoundedSemaphore(
+                    MAX_CHANNELS
+                )
+            return channels
+
+    def release(self, key: Hashable, client: paramiko.SSHClient) -> bool:
+        """Release a client, return `True` if it isn't used anymore."""
+        with self._lock:
+            if not (entry := self._clients.get(key)) or entry[0] is not client:
+                return True
+
+            if (users := entry[1] - 1) > 0:
+                self._clients[key] = (client, users)
+                return False
+
+            del self._clients[key]
+            return True
@@ -0,0 +1,71 @@
+import asyncio
+import socket
+import time
+
+DEFAULT_TTL = 300
+
+Address = tuple[int, tuple]
+
+_CACHE: dict[tuple[str, int], tuple[tuple[Address, ...], float]] = {}
+
+
+def _get_addresses(infos: list[tuple]) -> tuple[Address, ...]:
+    return tuple(
+        dict.fromkeys((family, sockaddr) for family, _, _, _, sockaddr in infos)
+    )
+
+
+class Resolver:
+    """Resolve the addresses of a host.
+
+    Addresses are returned as `(family, sockaddr)` in the order of
+    `getaddrinfo` without duplicates. The full list is cached for `ttl`
+    seconds and shared between all resolvers of the same host and port,
+    IP addresses are not looked up.
+    """
+
+    def __init__(self, host: str, port: int, ttl: int = DEFAULT_TTL) -> None:
+        self._key = (host, port)
+        self._ttl = ttl
+
+        try:
+            self._addresses = _get_addresses(
+                socket.getaddrinfo(
+                    host, port, type=socket.SOCK_STREAM, flags=socket.AI_NUMERICHOST
+                )
+            )
+        except socket.gaierror:
+            self._addresses = None
+
+    def _get_cached(self) -> tuple[Address, ...] | None:
+        if self._addresses:
+            return self._addresses
+        if (entry := _CACHE.get(self._key)) and time.monotonic() < entry[1]:
+            return entry[0]
+        return None
+
+    def _set_cached(self, infos: list[tuple]) -> tuple[Address, ...]:
+        addresses = _get_addresses(infos)
+        _CACHE[self._key] = (addresses, time.monotonic() + self._ttl)
+        return addresses
+
+    def resolve(self) -> tuple[Address, ...]:
+        """Get the addresses of the host."""
+        if addresses := self._get_cached():
+            return addresses
+
+        return self._set_cached(socket.getaddrinfo(*self._key, type=socket.SOCK_STREAM))
+
+    async def async_resolve(self) -> tuple[Address, ...]:
+        """Get the addresses of the host without blocking the event loop."""
+        if addresses := self._get_cached():
+            return addresses
+
+        loop = asyncio.get_running_loop()
+        return self._set_cached(
+            await loop.getaddrinfo(*self._key, type=socket.SOCK_STREAM)
+        )
+
+    def invalidate(self) -> None:
+        """Invalidate the cached addresses."""
+        _CACHE.pop(self._key, None)
@@ -1,16 +1,26 @@
+from collections.abc import Iterator
+from contextlib import contextmanager, suppress
+from functools import lru_cache
+import hashlib
 import logging
+import os
 import re
+import socket
+import threading
 import time
 
 import paramiko
 from terminal_manager import CommandError, CommandOutput, Event
 
 from .errors import SSHAuthenticationError, SSHConnectError, SSHHostKeyUnknownError
+from .pool import ClientPool
+from .resolver import Resolver
 from .state import CONNECTED, ERROR, State
 
-WIN_TITLE = re.compile(r"\x1b\]0\;.*?\x07")
-WIN_NEWLINE = re.compile(r"\x1b\[\d+\;1H")
-ANSI_ESCAPE = re.compile(r"\x1b(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
+WIN_TITLE = re.compile(rb"\x1b\]0\;.*?\x07")
+WIN_NEWLINE = re.compile(rb"\x1b\[\d+\;1H")
+ANSI_ESCAPE = re.compile(rb"\x1b(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
+CONTROL_CHARS = b"\b\r\0"
 
 END = "__exit_code__"
 PS_CODE = "$LastExitCode"
@@ -21,12 +31,47 @@ ZSH_PIPE = r"${pipestatus[@]}"
 
 ECHO_STRING = f'echo "{END}|{PS_CODE}|{LINUX_CODE}|{CMD_CODE}|{BASH_PIPE}|{ZSH_PIPE}"'
 EXIT_STRING = "exit"
+END_PREFIXES = (END, f'"{END}')
+SHELL_STRINGS = frozenset((ECHO_STRING, EXIT_STRING))
+
+BATCH_END = "__command_end__"
+BATCH_ECHO_STRING = f"printf '\\n{BATCH_END} %s\\n' $?; printf '\\n{BATCH_END}\\n' >&2"
+
+KEEPALIVE_REQUEST = "keepalive@openssh.com"
 
 CMD_START = "\x1b[?25l\x1b[2J\x1b[m\x1b[H"
 CMD_TEST = "Microsoft Windows"
+CMD_WAIT = 1.5
+
+SYSTEM_HOST_KEYS_FILENAME = os.path.expanduser("~/.ssh/known_hosts")
+
+SSHFP_ALGORITHMS = {"ssh-rsa": 1, "ssh-dss": 2, "ecdsa-sha2": 3, "ssh-ed25519": 4}
+SSHFP_HASHES = {1: hashlib.sha1, 2: hashlib.sha256}
 
 logging.getLogger("paramiko").setLevel(logging.CRITICAL)
 
+_CLIENT_POOL = ClientPool()
+
+
+@lru_cache(maxsize=16)
+def _read_host_keys(filename: str, mtime: int, size: int) -> paramiko.HostKeys:
+    return paramiko.HostKeys(filename)
+
+
+def _get_host_keys(filename: str) -> paramiko.HostKeys:
+    """Get the parsed host keys of a file, cached until the file changes."""
+    stat = os.stat(filename)
+    return _read_host_keys(filename, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=32)
+def _get_batch_script(strings: tuple[str, ...]) -> bytes:
+    return "".join(f"(\n{line}\n)\n{BATCH_ECHO_STRING}\n" for line in strings).encode()
+
+
+def _decode_lines(data: bytes) -> list[str]:
+    return data.decode(errors="replace").splitlines() if data else []
+
 
 class CustomRejectPolicy(paramiko.MissingHostKeyPolicy):
     def missing_host_key(
@@ -35,16 +80,92 @@ class CustomRejectPolicy(paramiko.MissingHostKeyPolicy):
         raise SSHHostKeyUnknownError(hostname)
 
 
+class SSHFPPolicy(paramiko.MissingHostKeyPolicy):
+    """Accept host keys that match a DNSSEC validated SSHFP record.
+
+    Requires `dnspython`, keys that can't be verified are passed on
+    to the fallback policy.
+    """
+
+    def __init__(self, host: str, fallback: paramiko.MissingHostKeyPolicy) -> None:
+        import dns.flags
+        import dns.resolver
+
+        self._host = host
+        self._fallback = fallback
+        self._resolver = dns.resolver.Resolver()
+        self._resolver.use_edns(0, dns.flags.DO, 1232)
+        self._records: list[tuple[int, int, bytes]] = []
+        self._expiration = 0.0
+
+    def _get_records(self) -> list[tuple[int, int, bytes]]:
+        import dns.exception
+        import dns.flags
+
+        if time.time() < self._expiration:
+            return self._records
+
+        try:
+            answer = self._resolver.resolve(
+                self._host, "SSHFP", raise_on_no_answer=False
+            )
+        except dns.exception.DNSException:
+            return []
+
+        if answer.response.flags & dns.flags.AD:
+            self._records = [
+                (record.algorithm, record.fp_type, record.fingerprint)
+                for record in answer
+            ]
+        else:
+            self._records = []
+
+        self._expiration = answer.expiration
+        return self._records
+
+    def _verify(self, key: paramiko.PKey) -> bool:
+        name = key.get_name()
+        algorithm = next(
+            (
+                value
+                for prefix, value in SSHFP_ALGORITHMS.items()
+                if name.startswith(prefix)
+            ),
+            None,
+        )
+
+        for record_algorithm, fp_type, fingerprint in self._get_records():
+            if record_algorithm != algorithm or fp_type not in SSHFP_HASHES:
+                continue
+            if SSHFP_HASHES[fp_type](key.asbytes()).digest() == fingerprint:
+                return True
+
+        return False
+
+    def missing_host_key(
+        self, client: paramiko.SSHClient, hostname: str, key: paramiko.PKey
+    ) -> None:
+        if not self._verify(key):
+            self._fallback.missing_host_key(client, hostname, key)
+
+
+_AUTO_ADD_POLICY = paramiko.AutoAddPolicy()
+_REJECT_POLICY = CustomRejectPolicy()
+
+
 class ShellParser:
     def __init__(self, stdin: list[str]) -> None:
         self._stdin = stdin
+        self._stdin_lines = frozenset(stdin)
+        self._checked = 0
+        self._count = 0
 
-    def _get_code(self, line: str) -> tuple[int, int]:
+    def _get_code(self, line: str) -> int:
         if len(fields := line.split("|")) != 6:
             return 0
 
         for item in fields[:4]:
-            if item.isnumeric() and (code := int(item)) != 0:
+            if item.isdecimal() and (code := int(item)) != 0:
                 return code
             if item == "False":
                 return 1
@@ -53,36 +174,68 @@ class ShellParser:
             return 0
 
         for item in fields[4].split() + fields[5].split():
-            if item.isnumeric() and (code := int(item)) != 0:
-                return int(item)
+            if item.isdecimal() and (code := int(item)) != 0:
+                return code
 
         return 0
 
+    def _get_string(self, stdout_bytes: bytes, errors: str = "strict") -> str:
+        if b"\x1b" in stdout_bytes:
+            stdout_bytes = WIN_TITLE.sub(b"", stdout_bytes)
+            stdout_bytes = WIN_NEWLINE.sub(b"\n", stdout_bytes)
+            stdout_bytes = ANSI_ESCAPE.sub(b"", stdout_bytes)
+        return stdout_bytes.translate(None, CONTROL_CHARS).decode(errors=errors)
+
     def _get_lines(self, stdout_bytes: bytes) -> list[str]:
-        string = stdout_bytes.decode()
-        string = WIN_TITLE.sub("", string)
-        string = WIN_NEWLINE.sub("\n", string)
-        string = ANSI_ESCAPE.sub("", string)
-        string = string.replace("\b", "").replace("\r", "").replace("\0", "")
-        return string.splitlines()
+        return self._get_string(stdout_bytes).splitlines()
+
+    def is_cmd_prompt(self, stdout_bytes: bytes, line: str) -> bool:
+        """Check if cmd printed its prompt again after the echo of `line`."""
+        _, found, tail = self._get_string(stdout_bytes, "replace").rpartition(line)
+        return bool(found) and tail.endswith(">")
+
+    def _count_end_lines(self, stdout_bytes: bytes) -> int:
+        string = self._get_string(stdout_bytes, "replace")
+        return sum(
+            1
+            for line in string.splitlines(True)
+            if line.startswith(END_PREFIXES) and line.endswith("\n")
+        )
+
+    def is_complete(self, stdout_bytes: bytes) -> bool:
+        """Check if the exit codes of all stdin lines have been received.
+
+        `stdout_bytes` must only grow between calls, lines that were
+        complete at the previous call are not checked again.
+        """
+        if end := stdout_bytes.rfind(b"\n", self._checked) + 1:
+            self._count += self._count_end_lines(stdout_bytes[self._checked : end])
+            self._checked = end
+
+        count = self._count + self._count_end_lines(stdout_bytes[self._checked :])
+        return count >= len(self._stdin)
 
     def parse(self, stdout_bytes: bytes) -> tuple[list[str], int]:
         """Get stdout and code."""
         stdout = []
         code = stdin_count = start = end = 0
 
-        for i, line in enumerate(lines := self._get_lines(stdout_bytes)):
-            if stdin_count > len(self._stdin) - 1:
+        # Lines typed ahead can be echoed before or after the output of the
+        # previous line, so they are dropped instead of marking a new start.
+        lines = [
+            line for line in self._get_lines(stdout_bytes) if line not in SHELL_STRINGS
+        ]
+        stdin = self._stdin
+        stdin_lines = self._stdin_lines
+
+        for i, line in enumerate(lines):
+            if stdin_count >= len(stdin):
                 break
-            if line.endswith(self._stdin[stdin_count]) or line in [
-                *self._stdin,
-                ECHO_STRING,
-                EXIT_STRING,
-            ]:
+            if line.endswith(stdin[stdin_count]) or line in stdin_lines:
                 start = end = i + 1
             elif line.endswith(ECHO_STRING):
                 end = i
-            elif line.startswith((END, f'"{END}')):
+            elif line.startswith(END_PREFIXES):
                 stdout.extend(lines[start:end])
                 code = code or self._get_code(line)
                 start = end = i + 1
@@ -102,10 +255,15 @@ class SSH:
         key_filename: str,
         host_keys_filename: str,
         add_host_keys: bool,
+        verify_host_key_dns: bool,
         load_system_host_keys: bool,
+        allow_agent: bool,
+        compress: bool,
         invoke_shell: bool,
         disconnect_mode: bool,
+        disconnect_delay: int,
         timeout: int,
+        keepalive_interval: int,
     ):
         self._state = state
         self._host = host
@@ -115,15 +273,45 @@ class SSH:
         self._key_filename = key_filename
         self._host_keys_filename = host_keys_filename
         self._load_system_host_keys = load_system_host_keys
+        self._allow_agent = allow_agent
+        self._compress = compress
         self._timeout = timeout
+        self._keepalive_interval = keepalive_interval
         self._disconnect_mode = disconnect_mode
+        self._disconnect_delay = disconnect_delay
+        self._disconnect_timer: threading.Timer | None = None
         self._invoke_shell = invoke_shell
-        self._client = paramiko.SSHClient()
-        self._client.set_log_channel("paramiko")
-        self._client.set_missing_host_key_policy(
-            paramiko.AutoAddPolicy if add_host_keys else CustomRejectPolicy
+        self._policy = _AUTO_ADD_POLICY if add_host_keys else _REJECT_POLICY
+        if verify_host_key_dns:
+            self._policy = SSHFPPolicy(host, self._policy)
+        self._system_host_keys = paramiko.HostKeys()
+        self._host_keys = paramiko.HostKeys()
+        self._client = self._make_client()
+        self._pool_key = (
+            host,
+            port,
+            username,
+            password,
+            key_filename,
+            host_keys_filename,
+            add_host_keys,
+            verify_host_key_dns,
+            load_system_host_keys,
+            allow_agent,
+            compress,
+            keepalive_interval,
         )
+        self._pooled = False
+        self._channels = _CLIENT_POOL.channels(self._pool_key)
+        self.resolver = Resolver(host, port)
         self.on_disconnect = Event()
+        self._lock = threading.RLock()
+        self._sessions = 0
+        self._shell: paramiko.Channel | None = None
+        self._shell_cmd = False
+        self._shell_lock = threading.Lock()
+        self._host_keys_loaded = False
+        self._last_success = 0.0
 
     @property
     def host(self) -> str:
@@ -133,11 +321,52 @@ class SSH:
     def disconnect_mode(self) -> bool:
         return self._disconnect_mode
 
+    @property
+    def invoke_shell(self) -> bool:
+        return self._invoke_shell
+
+    @property
+    def active(self) -> bool:
+        transport = self._client.get_transport()
+        return transport is not None and transport.is_active()
+
+    @property
+    def recently_active(self) -> bool:
+        """Whether a command succeeded within the keepalive interval."""
+        return (
+            bool(self._keepalive_interval)
+            and self.active
+            and time.monotonic() - self._last_success < self._keepalive_interval
+        )
+
+    def _make_client(self) -> paramiko.SSHClient:
+        client = paramiko.SSHClient()
+        client.set_log_channel("paramiko")
+        client.set_missing_host_key_policy(self._policy)
+        client._system_host_keys = self._system_host_keys
+        client._host_keys = self._host_keys
+        client._host_keys_filename = self._host_keys_filename
+        return client
+
     def connect(self) -> None:
+        with self._lock:
+            self._connect()
+
+    def _connect(self) -> None:
         if self._state.connected:
             return
 
+        if client := _CLIENT_POOL.acquire(self._pool_key):
+            self._client = client
+            self._pooled = True
+            self._state.batch_update({CONNECTED: True, ERROR: False})
+            return
+
         try:
+            if not self._host_keys_loaded:
+                self.load_host_keys()
+            self._client = self._make_client()
+            sock = self._open_socket()
             self._client.connect(
                 self._host,
                 self._port,
@@ -145,7 +374,9 @@ class SSH:
                 self._password,
                 key_filename=self._key_filename,
                 timeout=self._timeout,
-                allow_agent=False,
+                allow_agent=self._allow_agent,
+                compress=self._compress,
+                sock=sock,
             )
         except SSHHostKeyUnknownError:
             self.disconnect()
@@ -157,50 +388,187 @@ class SSH:
             raise SSHAuthenticationError(exc) from exc
         except Exception as exc:
             self.disconnect()
+            self.resolver.invalidate()
             raise SSHConnectError(exc) from exc
 
-        self._state.update(CONNECTED, True)
-        self._state.update(ERROR, False)
+        if self._keepalive_interval:
+            self._client.get_transport().set_keepalive(self._keepalive_interval)
+
+        self._pooled = _CLIENT_POOL.add(self._pool_key, self._client)
+        self._state.batch_update({CONNECTED: True, ERROR: False})
+
+    def _open_socket(self) -> socket.socket:
+        error: OSError | None = None
+
+        for family, address in self.resolver.resolve():
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self._timeout)
+            try:
+                sock.connect(address)
+            except OSError as exc:
+                sock.close()
+                error = exc
+            else:
+                return sock
+
+        raise error
+
+    def check_alive(self) -> bool:
+        """Check the connection with a keepalive request.
+
+        The transport is closed if the server doesn't reply in time.
+        """
+        transport = self._client.get_transport()
+
+        if transport is None or not transport.is_active():
+            return False
+
+        timer = threading.Timer(self._timeout, transport.close)
+        timer.daemon = True
+        timer.start()
+
+        try:
+            transport.global_request(KEEPALIVE_REQUEST)
+        except Exception:  # noqa: BLE001
+            transport.close()
+        finally:
+            timer.cancel()
+
+        if alive := transport.is_active():
+            self._last_success = time.monotonic()
+
+        return alive
 
     def disconnect(self, notify: bool = True) -> None:
-        self._client.close()
-        self._state.update(CONNECTED, False)
+        with self._lock:
+            self._cancel_disconnect_timer()
+
+            if self._shell:
+                self._shell.close()
+                self._shell = None
+
+            if not self._pooled or _CLIENT_POOL.release(self._pool_key, self._client):
+                self._client.close()
+            else:
+                self._client = self._make_client()
+
+            self._pooled = False
+            self._state.update(CONNECTED, False)
 
         if notify:
             self.on_disconnect.notify()
 
     def load_host_keys(self) -> None:
         if self._load_system_host_keys:
-            self._client.load_system_host_keys()
+            with suppress(OSError):
+                self._system_host_keys = _get_host_keys(SYSTEM_HOST_KEYS_FILENAME)
         if self._host_keys_filename:
-            with open(self._host_keys_filename, "a", encoding="utf-8"):
-                pass
-            self._client.load_host_keys(self._host_keys_filename)
+            # Create the file without touching its mtime, which keys the cache
+            os.close(
+                os.open(
+                    self._host_keys_filename,
+                    os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                    0o600,
+                )
+            )
+            self._host_keys = paramiko.HostKeys()
+            self._host_keys._entries = [
+                *_get_host_keys(self._host_keys_filename)._entries
+            ]
 
-    def execute_command_string(self, string: str, timeout: int) -> CommandOutput:
-        if self._disconnect_mode and self._state.online and not self._state.connected:
-            try:
-                self.connect()
-            except Exception as exc:
-                raise CommandError("Failed to connect", exc) from exc
+        self._host_keys_loaded = True
+
+    def _cancel_disconnect_timer(self) -> None:
+        if self._disconnect_timer:
+            self._disconnect_timer.cancel()
+            self._disconnect_timer = None
+
+    def _start_disconnect_timer(self) -> None:
+        self._disconnect_timer = threading.Timer(
+            self._disconnect_delay, self._disconnect_idle
+        )
+        self._disconnect_timer.daemon = True
+        self._disconnect_timer.start()
+
+    def _disconnect_idle(self) -> None:
+        with self._lock:
+            if self._disconnect_timer is threading.current_thread():
+                self.disconnect(False)
+
+    @contextmanager
+    def _session(self) -> Iterator[None]:
+        with self._lock:
+            self._cancel_disconnect_timer()
 
-        if not self._state.connected:
-            raise CommandError("Not connected")
+            if reconnect := self._state.connected and not self.active:
+                self.disconnect(False)
+
+            if (
+                (self._disconnect_mode or reconnect)
+                and self._state.online
+                and not self._state.connected
+            ):
+                try:
+                    self._connect()
+                except Exception as exc:
+                    raise CommandError("Failed to connect", exc) from exc
+
+            if not self._state.connected:
+                raise CommandError("Not connected")
+
+            self._sessions += 1
 
         try:
-            if self._invoke_shell:
-                return self._execute_invoke_shell(string, timeout)
-            return self._execute(string, timeout)
+            yield
+            self._last_success = time.monotonic()
         except TimeoutError as exc:
             raise CommandError("Timeout during command", exc) from exc
         except CommandError:
             self.disconnect()
             raise
         finally:
-            if self._disconnect_mode and self._state.connected:
-                self.disconnect(False)
+            with self._lock:
+                self._sessions -= 1
+                if (
+                    self._disconnect_mode
+                    and self._state.connected
+                    and not self._sessions
+                ):
+                    if self._disconnect_delay:
+                        self._start_disconnect_timer()
+                    else:
+                        self.disconnect(False)
+
+    @contextmanager
+    def _channel(self, timeout: int) -> Iterator[None]:
+        if not self._channels.acquire(timeout=timeout):
+            raise TimeoutError("No free channel")
+
+        try:
+            yield
+        finally:
+            self._channels.release()
+
+    def execute_command_string(self, string: str, timeout: int) -> CommandOutput:
+        with self._session():
+            if self._invoke_shell:
+                return self._execute_invoke_shell(string, timeout)
+            with self._channel(timeout):
+                return self._execute(string, timeout)
+
+    def execute_command_strings(
+        self, strings: list[str], timeout: int
+    ) -> list[CommandOutput]:
+        """Execute multiple command strings over a single channel.
+
+        Requires a POSIX shell on the remote side.
+        """
+        with self._session(), self._channel(timeout):
+            return self._execute_batch(strings, timeout)
 
     def _execute(self, string: str, timeout: int) -> CommandOutput:
+        timestamp = time.time()
+
         try:
             stdin, stdout, stderr = self._client.exec_command(
                 string,
@@ -212,9 +580,9 @@ class SSH:
         try:
             return CommandOutput(
                 string,
-                time.time(),
-                ["".join(line.splitlines()) for line in stdout],
-                ["".join(line.splitlines()) for line in stderr],
+                timestamp,
+                _decode_lines(stdout.read()),
+                _decode_lines(stderr.read()),
                 stdout.channel.recv_exit_status(),
             )
         except TimeoutError:
@@ -223,65 +591,158 @@ class SSH:
         except Exception as exc:
             raise CommandError("Failed to read command output", exc) from exc
 
-    def _execute_invoke_shell(self, string: str, timeout: int) -> CommandOutput:
+    def _execute_batch(self, strings: list[str], timeout: int) -> list[CommandOutput]:
+        timestamp = time.time()
+
         try:
-            channel = self._client.invoke_shell(width=4095)
+            stdin, stdout, stderr = self._client.exec_command(
+                _get_batch_script(tuple(strings)),
+                timeout=float(timeout),
+            )
         except Exception as exc:
-            raise CommandError("Failed to open channel", exc) from exc
-
-        channel.settimeout(float(timeout))
-        stdin_file = channel.makefile_stdin("wb")
-        stdout_file = channel.makefile("r")
+            raise CommandError("Failed to execute commands", exc) from exc
 
         try:
-            cmd = self._detect_cmd(stdout_file)
+            stdout_string = stdout.read().decode(errors="replace")
+            stderr_string = stderr.read().decode(errors="replace")
+            stdout.channel.recv_exit_status()
+        except TimeoutError:
+            stdin.channel.close()
+            raise
         except Exception as exc:
-            raise CommandError("Failed to detect shell", exc) from exc
+            raise CommandError("Failed to read command output", exc) from exc
+
+        stdout_parts = stdout_string.split(f"\n{BATCH_END} ")
+        stderr_parts = stderr_string.split(f"\n{BATCH_END}\n")
+        count = len(strings) + 1
+
+        if len(stdout_parts) != count or len(stderr_parts) != count:
+            raise CommandError("Failed to parse command output")
+
+        outputs = []
+        stdout_data = stdout_parts[0]
+
+        for i, string in enumerate(strings):
+            code, _, next_stdout_data = stdout_parts[i + 1].partition("\n")
+            outputs.append(
+                CommandOutput(
+                    string,
+                    timestamp,
+                    stdout_data.splitlines(),
+                    stderr_parts[i].splitlines(),
+                    int(code),
+                )
+            )
+            stdout_data = next_stdout_data
+
+        return outputs
+
+    def _open_shell(self, timeout: int) -> paramiko.Channel:
+        if (channel := self._shell) and not (channel.closed or channel.eof_received):
+            return channel
 
         try:
-            for line in (stdin := string.splitlines()):
-                stdin_file.write(line + "\r")
-                if cmd:
-                    time.sleep(1.5)
-                stdin_file.write(ECHO_STRING + "\r")
-            stdin_file.write(EXIT_STRING + "\r")
+            channel = self._client.invoke_shell(width=4095)
         except Exception as exc:
-            raise CommandError("Failed to send command", exc) from exc
+            raise CommandError("Failed to open channel", exc) from exc
+
+        channel.settimeout(float(timeout))
 
         try:
-            stdout_bytes = stdout_file.read()
-        except TimeoutError:
-            raise
+            self._shell_cmd = self._detect_cmd(channel)
         except Exception as exc:
-            raise CommandError("Failed to read command output", exc) from exc
-        finally:
             channel.close()
+            raise CommandError("Failed to detect shell", exc) from exc
+
+        self._shell = channel
+        return channel
+
+    def _close_shell(self) -> None:
+        if self._shell:
+            self._shell.close()
+            self._shell = None
+
+    def _execute_invoke_shell(self, string: str, timeout: int) -> CommandOutput:
+        with self._shell_lock:
+            channel = self._open_shell(timeout)
+            channel.settimeout(float(timeout))
+            parser = ShellParser(stdin := string.splitlines())
+            timestamp = time.time()
+            stdout_bytes = bytearray()
+
+            try:
+                if self._shell_cmd:
+                    for line in stdin:
+                        channel.sendall(f"{line}\r".encode())
+                        self._wait_cmd_prompt(channel, parser, line, stdout_bytes)
+                        channel.settimeout(float(timeout))
+                        channel.sendall(f"{ECHO_STRING}\r".encode())
+                else:
+                    channel.sendall(
+                        "".join(f"{line}\r{ECHO_STRING}\r" for line in stdin).encode()
+                    )
+            except Exception as exc:
+                self._close_shell()
+                raise CommandError("Failed to send command", exc) from exc
+
+            try:
+                while not parser.is_complete(stdout_bytes):
+                    if not (data := channel.recv(65536)):
+                        self._close_shell()
+                        break
+                    stdout_bytes += data
+            except TimeoutError:
+                self._close_shell()
+                raise
+            except Exception as exc:
+                self._close_shell()
+                raise CommandError("Failed to read command output", exc) from exc
 
         try:
-            stdout, code = ShellParser(stdin).parse(stdout_bytes)
+            stdout, code = parser.parse(stdout_bytes)
         except Exception as exc:
             raise CommandError("Failed to parse command output", exc) from exc
 
         return CommandOutput(
             string,
-            time.time(),
+            timestamp,
             stdout,
             [],
             code,
         )
 
-    def _detect_cmd(self, stdout_file: paramiko.ChannelFile) -> bool:
-        if stdout_file.read(16).decode() != CMD_START:
-            return False
+    def _wait_cmd_prompt(
+        self,
+        channel: paramiko.Channel,
+        parser: ShellParser,
+        line: str,
+        stdout_bytes: bytearray,
+    ) -> None:
+        start = len(stdout_bytes)
+        deadline = time.monotonic() + CMD_WAIT
 
-        test_line = ""
-        char = stdout_file.read(1).decode()
+        with suppress(TimeoutError):
+            while (remaining := deadline - time.monotonic()) > 0:
+                channel.settimeout(remaining)
+                if not (data := channel.recv(65536)):
+                    return
+                stdout_bytes += data
+                if parser.is_cmd_prompt(stdout_bytes[start:], line):
+                    return
+
+    def _detect_cmd(self, channel: paramiko.Channel) -> bool:
+        data = b""
+
+        while len(data) < 16 and (chunk := channel.recv(1024)):
+            data += chunk
+
+        if data[:16].decode() != CMD_START:
+            return False
 
-        while char in ["\r", "\n"]:
-            char = stdout_file.read(1).decode()
+        data = data[16:].lstrip(b"\r\n")
 
-        while char not in ["\r", "\n"]:
-            test_line += char
-            char = stdout_file.read(1).decode()
+        while not re.search(b"[\r\n]", data) and (chunk := channel.recv(1024)):
+            data = (data + chunk).lstrip(b"\r\n")
 
+        test_line = re.split(b"[\r\n]", data, maxsplit=1)[0].decode()
         return CMD_TEST in test_line
@@ -1,3 +1,4 @@
+import logging
 from logging import Logger
 
 from terminal_manager import Event
@@ -8,19 +9,41 @@ ERROR = "error"
 
 
 class State:
-    online: bool = False
-    connected: bool = False
-    error: bool = False
+    __slots__ = ("_logger", "_name", "connected", "error", "on_change", "online")
+
+    online: bool
+    connected: bool
+    error: bool
 
     def __init__(self, name: str, logger: Logger) -> None:
+        self.online = False
+        self.connected = False
+        self.error = False
         self._name = name
         self._logger = logger
         self.on_change = Event()
 
-    def update(self, name, value) -> None:
+    def _set(self, name: str, value: bool) -> bool:
         if getattr(self, name) == value:
-            return
+            return False
 
         setattr(self, name, value)
-        self._logger.debug("%s: state.%s => %s", self._name, name, value)
-        self.on_change.notify(self)
+
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("%s: state.%s => %s", self._name, name, value)
+
+        return True
+
+    def update(self, name: str, value: bool) -> None:
+        if self._set(name, value):
+            self.on_change.notify(self)
+
+    def batch_update(self, values: dict[str, bool]) -> None:
+        """Update multiple values and notify once if any changed."""
+        changed = False
+
+        for name, value in values.items():
+            changed = self._set(name, value) or changed
+
+        if changed:
+            self.on_change.notify(self)